@@ -2,6 +2,7 @@
 # /// script
 # requires-python = ">=3.14"
 # dependencies = [
+#     "blake3>=1.0.0",
 #     "humanfriendly>=10.0",
 #     "rich>=14.3.3",
 #     "tiktoken>=0.12.0",
@@ -9,86 +10,451 @@
 # ///
 
 import os
+import re
 import sys
 import enum
 import glob
+import queue
 import time
-import hashlib
+import functools
+import itertools
 import sqlite3
 import argparse
+import collections
 import threading
+import multiprocessing
 import concurrent.futures
+from collections.abc import Iterator
 
+import blake3
 import tiktoken
 import humanfriendly
-from rich.table import Table
-from rich.console import Console
-from rich.progress import Progress, MofNCompleteColumn
 from rich_argparse import RichHelpFormatter
 
 try:
-    CORE_COUNT = os.process_cpu_count()  # type: ignore
+    # None if the count can't be determined; the pipeline sizes its queues
+    # from the worker count, so it needs a number
+    CORE_COUNT = os.process_cpu_count() or 1  # type: ignore
 except AttributeError:
     CORE_COUNT = len(os.sched_getaffinity(0))
 
+# On free-threaded builds tokenizer threads run truly in parallel; otherwise
+# we tokenize in worker processes to get out from under the GIL
+GIL_ENABLED = getattr(sys, "_is_gil_enabled", lambda: True)()
+
 
 class ExitCodes(enum.IntEnum):
     OK = 0
     NOFILES = enum.auto()
 
 
+# Files are read and hashed this many bytes at a time
+READ_BUFFER_SIZE = 1 << 20
+
+# Number of threads listing directories when scanning everything
+WALK_THREADS = 8
+
+# Files with a NUL byte in this many leading bytes are treated as binary, as
+# git does, and skipped
+BINARY_SNIFF_SIZE = 8192
+
+# Files at least this large are hashed using blake3's own thread pool
+BLAKE3_THREADED_SIZE = 1 << 24
+
+# Number of cache misses to collect before handing them to a tokenizer worker
+BATCH_SIZE = 64
+
+# Number of files being read and hashed ahead of the main loop, per thread,
+# and of batches waiting on the tokenizer, per worker; these bound how many
+# files' contents are held in memory at once
+HASH_AHEAD = 4
+BATCHES_AHEAD = 2
+
+# Minimum number of seconds between updates to the token count on screen
+PROGRESS_INTERVAL = 1 / 30
+
+# Number of digests to look up in the cache per query; kept below SQLite's
+# historical limit of 999 bound parameters per statement
+LOOKUP_BATCH_SIZE = 900
+
+CACHE_DB = "cache.db"
+
+# The cache database and the files SQLite keeps alongside it (in WAL mode,
+# or while a transaction is open), which shouldn't be counted themselves
+CACHE_DB_FILES = [CACHE_DB, f"{CACHE_DB}-wal", f"{CACHE_DB}-shm", f"{CACHE_DB}-journal"]
+
 TIKTOKEN_ENCODINGS = ["o200k_base", "cl100k_base", "p50k_base", "r50k_base"]
 
+DEFAULT_ENCODING = "o200k_base"
+
+# The encoding each model family tokenizes with; smaller vocabularies like
+# cl100k_base are also noticeably faster to encode
+TARGET_MODEL_ENCODINGS = {
+    "gpt-4o": "o200k_base",
+    "gpt-4": "cl100k_base",
+    "gpt-3.5": "cl100k_base",
+}
+
 HELP_EPILOGUE = """
 The tiktoken library, which this script uses, supports several encoding options; for more information about them: https://github.com/openai/openai-cookbook/blob/main/examples/How_to_count_tokens_with_tiktoken.ipynb
 """
 
 
+def _translate_glob(pattern: str) -> str:
+    # A cut-down glob.translate(pattern, recursive=True) for Python < 3.13:
+    # wildcards don't match "/" or a leading ".", and a "**" component
+    # matches any number of directories
+    components = pattern.split("/")
+    regex = ""
+    for i, component in enumerate(components):
+        last = i == len(components) - 1
+        if component == "**":
+            regex += "(?:[^/.][^/]*/)*"
+            if last:
+                regex += "(?:[^/.][^/]*)?"
+            continue
+        if component == "*":
+            # A lone * matches a non-empty name
+            component = "?*"
+        if component[:1] in ("*", "?"):
+            regex += r"(?!\.)"
+        j = 0
+        while j < len(component):
+            char = component[j]
+            j += 1
+            if char == "[":
+                # A "]" straight after "[" or "[!" is part of the set
+                end = component.find("]", j + 1 + (component[j : j + 1] == "!"))
+            else:
+                end = -1
+            if char == "*":
+                regex += "[^/]*"
+            elif char == "?":
+                regex += "[^/]"
+            elif end != -1:
+                chars = component[j:end].replace("\\", "\\\\")
+                if chars.startswith("!"):
+                    chars = "^" + chars[1:]
+                elif chars.startswith("^"):
+                    chars = "\\" + chars
+                regex += f"[{chars}]"
+                j = end + 1
+            else:
+                regex += re.escape(char)
+        if not last:
+            regex += "/"
+    return rf"(?s:{regex})\Z"
+
+
+try:
+    translate_glob = functools.partial(glob.translate, recursive=True)  # type: ignore
+except AttributeError:
+    translate_glob = _translate_glob
+
+
+def compile_excludes(patterns: list[str]) -> re.Pattern | None:
+    if not patterns:
+        return None
+    # Paths are normalized before they're matched too, so ./a/* matches a/x
+    return re.compile(
+        "|".join(translate_glob(os.path.normpath(p)) for p in patterns)
+    )
+
+
+def expand_globs(
+    patterns: list[str], exclude: re.Pattern | None = None
+) -> Iterator[str]:
+    for pattern in patterns:
+        for path in glob.iglob(pattern, recursive=True):
+            if not (exclude and exclude.match(os.path.normpath(path))):
+                yield path
+        # Paths named outright on the command line are always scanned, even
+        # if excluded or if their names look like globs
+        yield pattern
+
+
+def scan_dir(
+    top: str, exclude: re.Pattern | None, ancestors: frozenset[tuple[int, int]]
+) -> tuple[list[str], list[tuple[str, frozenset[tuple[int, int]]]]]:
+    # Mirrors glob("**/*"): hidden entries are skipped and symlinked
+    # directories are followed, except back into a directory we're already
+    # inside of, which would loop forever
+    files, dirs = [], []
+    try:
+        entries = os.scandir(top or ".")
+    except OSError:
+        # Like glob, skip directories we can't list
+        return files, dirs
+    with entries:
+        for entry in entries:
+            if entry.name.startswith("."):
+                continue
+            path = os.path.join(top, entry.name) if top else entry.name
+            try:
+                if entry.is_dir():
+                    # A directory is only skipped when an exclude matches
+                    # everything in it, like node_modules/**
+                    if exclude and exclude.match(path + "/"):
+                        continue
+                    st = entry.stat()
+                    key = (st.st_dev, st.st_ino)
+                    if key not in ancestors:
+                        dirs.append((path, ancestors | {key}))
+                elif entry.is_file() and not (exclude and exclude.match(path)):
+                    files.append(path)
+            except OSError:
+                # e.g. a dangling symlink, or a file removed as we go
+                continue
+    return files, dirs
+
+
+def walk(exclude: re.Pattern | None = None) -> Iterator[str]:
+    # Each directory is listed as a separate task, so slow readdir/stat calls
+    # (e.g. on network filesystems) overlap across the whole tree
+    st = os.stat(".")
+    root = frozenset({(st.st_dev, st.st_ino)})
+    with concurrent.futures.ThreadPoolExecutor(max_workers=WALK_THREADS) as executor:
+        pending = {executor.submit(scan_dir, "", exclude, root)}
+        while pending:
+            done, pending = concurrent.futures.wait(
+                pending, return_when=concurrent.futures.FIRST_COMPLETED
+            )
+            for future in done:
+                files, dirs = future.result()
+                yield from files
+                pending.update(
+                    executor.submit(scan_dir, d, exclude, ancestors)
+                    for d, ancestors in dirs
+                )
+
+
+def hash_file(path: str, size: int) -> tuple[bytes | None, list[bytes]]:
+    with open(path, "rb", buffering=0) as infile:
+        # Files that fit in one buffer are read in a single go so they end up
+        # as one bytes object, which joins without a copy before decoding;
+        # larger ones are sniffed before reading any further
+        if size <= READ_BUFFER_SIZE:
+            head = infile.read(READ_BUFFER_SIZE)
+        else:
+            head = infile.read(BINARY_SNIFF_SIZE)
+        if not head or head.find(b"\0", 0, BINARY_SNIFF_SIZE) != -1:
+            return None, []
+        if size >= BLAKE3_THREADED_SIZE:
+            hasher = blake3.blake3(head, max_threads=blake3.blake3.AUTO)
+        else:
+            hasher = blake3.blake3(head)
+        parts = [head]
+        while chunk := infile.read(READ_BUFFER_SIZE):
+            hasher.update(chunk)
+            parts.append(chunk)
+    return hasher.digest(), parts
+
+
+_worker_encoding = None
+
+
+def _init_worker(encoding: str):
+    global _worker_encoding
+    _worker_encoding = tiktoken.get_encoding(encoding)
+
+
+def _count_tokens(contents: list[list[bytes]]) -> list[int]:
+    # The batching happens in the pool: encode_ordinary_batch is only a
+    # thread pool mapping encode_ordinary, which on one thread per worker
+    # adds a thread per batch and keeps every file's tokens alive at once
+    counts = []
+    for parts in contents:
+        text = b"".join(parts).decode("utf-8", errors="ignore")
+        # Special tokens like <|endoftext|> are just text in source files
+        counts.append(len(_worker_encoding.encode_ordinary(text)))
+    return counts
+
+
+def default_tiktoken_cache_dir() -> str:
+    cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+    return os.path.join(cache_home, "tokenator", "tiktoken")
+
+
 class FileTokenizer:
-    def __init__(self, encoding: str, cache=True):
-        self.cache_data = {}
+    def __init__(
+        self, encoding: str, cache=True, workers: int = CORE_COUNT, max_size: int = 0
+    ):
         self.cache = cache
+        self.cache_data: dict[bytes, int] = {}
+        self.max_size = max_size
         self.load_cache()
-        self.encoding = tiktoken.get_encoding(encoding)
         self.lock = threading.Lock()
+        # Writes go through a queue to a single thread with its own
+        # connection, which commits whatever has queued up in one go
+        self.write_queue: queue.SimpleQueue = queue.SimpleQueue()
+        if self.cache:
+            self.writer = threading.Thread(target=self.write_cache, daemon=True)
+            self.writer.start()
+        self.encoding = encoding
+        self.encoding_loaded = False
+        # tiktoken otherwise keeps its BPE files under the system temp
+        # directory; workers inherit this so they all share one copy
+        if "DATA_GYM_CACHE_DIR" not in os.environ:
+            os.environ.setdefault("TIKTOKEN_CACHE_DIR", default_tiktoken_cache_dir())
+        if GIL_ENABLED:
+            if "forkserver" in multiprocessing.get_all_start_methods():
+                context = multiprocessing.get_context("forkserver")
+            else:
+                context = multiprocessing.get_context("spawn")
+            self.pool = concurrent.futures.ProcessPoolExecutor(
+                max_workers=workers,
+                mp_context=context,
+                initializer=_init_worker,
+                initargs=(encoding,),
+            )
+        else:
+            self.pool = concurrent.futures.ThreadPoolExecutor(
+                max_workers=workers,
+                initializer=_init_worker,
+                initargs=(encoding,),
+            )
 
     def load_cache(self):
         if self.cache is False:
             return
-        self.conn = sqlite3.connect("cache.db", check_same_thread=False)
+        self.conn = sqlite3.connect(CACHE_DB, check_same_thread=False)
         self.cur = self.conn.cursor()
-        self.cur.execute("CREATE TABLE IF NOT EXISTS cache(hash, token_count)")
-        self.cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS hashdex ON cache(hash)")
+        # WAL with synchronous=NORMAL only syncs at checkpoints rather than on
+        # every commit, which is plenty for a cache we can always rebuild.
+        self.cur.execute("PRAGMA journal_mode=WAL")
+        self.cur.execute("PRAGMA synchronous=NORMAL")
+        self.cur.execute("PRAGMA temp_store=MEMORY")
+        self.cur.execute("PRAGMA mmap_size=268435456")
+        res = self.cur.execute(
+            "SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'cache'"
+        )
+        table = res.fetchone()
+        if table and "encoding" not in table[0]:
+            self.migrate_cache()
+        # Counts depend on the encoding, so the same file can have one row for
+        # each encoding it's been counted with
+        self.cur.execute(
+            "CREATE TABLE IF NOT EXISTS cache(hash BLOB, encoding TEXT, token_count INTEGER, "
+            "PRIMARY KEY(hash, encoding)) WITHOUT ROWID"
+        )
+        # Maps a file's identity to its digest so unchanged files needn't be
+        # read and hashed again
+        self.cur.execute(
+            "CREATE TABLE IF NOT EXISTS pathcache(path TEXT PRIMARY KEY, mtime_ns INTEGER, size INTEGER, digest BLOB)"
+        )
+        self.conn.commit()
+
+    def migrate_cache(self):
+        # Older caches stored hex SHA-256 digests in a rowid table with a
+        # separate unique index, which can never match a BLAKE3 digest, or
+        # didn't record which encoding a count was for. Either way the rows
+        # can't be trusted, so drop them and let load_cache create the table.
+        self.cur.execute("DROP INDEX IF EXISTS hashdex")
+        self.cur.execute("DROP TABLE cache")
         self.conn.commit()
-        res = self.cur.execute("SELECT * FROM cache")
-        self.cache_data = dict(res.fetchall())
 
-    def cache_save(self, digest: str, count: int):
+    def write_cache(self):
+        conn = sqlite3.connect(CACHE_DB)
+        conn.execute("PRAGMA synchronous=NORMAL")
+        done = False
+        while not done:
+            writes = [self.write_queue.get()]
+            while not self.write_queue.empty():
+                writes.append(self.write_queue.get())
+            for write in writes:
+                if write is None:
+                    done = True
+                    continue
+                conn.executemany(*write)
+            conn.commit()
+        conn.close()
+
+    def cache_lookup(self, digests: list[bytes]) -> dict[bytes, int]:
+        # Counts seen earlier in this run (e.g. duplicated files) are kept in
+        # memory so they don't need another trip to the database
+        found = {d: self.cache_data[d] for d in digests if d in self.cache_data}
+        if self.cache is False:
+            return found
+        unknown = [d for d in digests if d not in found]
         with self.lock:
-            try:
-                self.cur.execute("INSERT INTO cache VALUES (?, ?)", (digest, count))
-                self.conn.commit()
-            except sqlite3.IntegrityError:
-                pass
-            self.cache_data[digest] = count
-
-    def tokenize_file(self, path: str):
-        with open(path, "r", encoding="utf-8", errors="ignore") as infile:
-            file_content = infile.read()
-            if len(file_content) == 0:
-                return 0
-        digest = hashlib.sha256(file_content.encode()).hexdigest()
-        try:
-            count = self.cache_data[digest]
-        except KeyError:
-            count = len(self.encoding.encode(file_content))
-            self.cache_save(digest, count)
-        return count
+            for i in range(0, len(unknown), LOOKUP_BATCH_SIZE):
+                chunk = unknown[i : i + LOOKUP_BATCH_SIZE]
+                placeholders = ",".join("?" * len(chunk))
+                res = self.conn.execute(
+                    "SELECT hash, token_count FROM cache "
+                    f"WHERE encoding = ? AND hash IN ({placeholders})",
+                    [self.encoding, *chunk],
+                )
+                found.update(res.fetchall())
+        self.cache_data.update(found)
+        return found
+
+    def cache_save(self, rows: list[tuple[bytes, int]]):
+        self.cache_data.update(rows)
+        if self.cache is False:
+            return
+        self.write_queue.put(
+            (
+                "INSERT OR IGNORE INTO cache VALUES (?, ?, ?)",
+                [(digest, self.encoding, count) for digest, count in rows],
+            )
+        )
 
+    def path_save(self, rows: list[tuple[str, int, int, bytes]]):
+        if self.cache is False:
+            return
+        self.write_queue.put(
+            (
+                "INSERT OR REPLACE INTO pathcache VALUES (?, ?, ?, ?)",
+                [(os.path.abspath(path), *rest) for path, *rest in rows],
+            )
+        )
 
-def main():
-    console = Console()
+    def hash_file(
+        self, path: str
+    ) -> tuple[str, os.stat_result, bytes | None, list[bytes] | None, int | None]:
+        # If the file's path, mtime and size match a previous run and we know
+        # its token count, the file isn't read at all and contents is None.
+        # Otherwise the token count is None unless the file is skipped.
+        st = os.stat(path)
+        if st.st_size == 0:
+            return path, st, None, None, 0
+        if self.max_size and st.st_size > self.max_size:
+            print(
+                f"Skipping {path}: {humanfriendly.format_size(st.st_size)} is larger than the maximum file size",
+                file=sys.stderr,
+            )
+            return path, st, None, None, 0
+        if self.cache:
+            with self.lock:
+                res = self.conn.execute(
+                    "SELECT hash, token_count FROM pathcache JOIN cache ON hash = digest "
+                    "WHERE path = ? AND mtime_ns = ? AND size = ? AND encoding = ?",
+                    (os.path.abspath(path), st.st_mtime_ns, st.st_size, self.encoding),
+                )
+                row = res.fetchone()
+            if row:
+                return path, st, row[0], None, row[1]
+        digest, parts = hash_file(path, st.st_size)
+        return path, st, digest, parts, None if digest else 0
 
+    def tokenize_batch(self, contents: list[list[bytes]]) -> concurrent.futures.Future:
+        if not self.encoding_loaded:
+            # Make sure the BPE file is downloaded and on disk before the
+            # workers start, so they read it from the (warm) page cache rather
+            # than all fetching it at once
+            tiktoken.get_encoding(self.encoding)
+            self.encoding_loaded = True
+        return self.pool.submit(_count_tokens, contents)
+
+    def close(self, cancel=False):
+        self.pool.shutdown(wait=not cancel, cancel_futures=cancel)
+        if self.cache:
+            self.write_queue.put(None)
+            self.writer.join()
+
+
+def main():
     parser = argparse.ArgumentParser(
         description="A script to wrap the tiktoken tokenizer to count tokens in a codebase.",
         epilog=HELP_EPILOGUE,
@@ -107,11 +473,16 @@ def main():
         default=0,
         help="The length of the content window to compare against",
     )
-    parser.add_argument(
+    encoding_group = parser.add_mutually_exclusive_group()
+    encoding_group.add_argument(
         "--tokenizer-encoding",
         choices=TIKTOKEN_ENCODINGS,
-        default="o200k_base",
-        help="The tokenizer encoding to use; default: o200k_base",
+        help=f"The tokenizer encoding to use; default: {DEFAULT_ENCODING}",
+    )
+    encoding_group.add_argument(
+        "--target-model",
+        choices=TARGET_MODEL_ENCODINGS,
+        help="Use the tokenizer encoding for this model instead of picking one",
     )
     parser.add_argument(
         "--no-cache",
@@ -122,34 +493,42 @@ def main():
     )
     parser.add_argument(
         "--parallel",
+        type=int,
         default=CORE_COUNT,
         help="The number of parallel threads to use; defaults to the number of CPU cores available to the script.",
     )
+    parser.add_argument(
+        "--max-file-size",
+        type=humanfriendly.parse_size,
+        default=0,
+        help="Skip files larger than this size (e.g. 2MiB); default: no limit",
+    )
 
     args = parser.parse_args()
 
+    # Imported here rather than at the top so that --help, and tokenizer
+    # worker processes (which import this module), don't pay for them
+    from rich.table import Table
+    from rich.console import Console
+    from rich.progress import Progress, MofNCompleteColumn
+
+    console = Console()
+
+    if args.tokenizer_encoding is None:
+        args.tokenizer_encoding = TARGET_MODEL_ENCODINGS.get(
+            args.target_model, DEFAULT_ENCODING
+        )
+
+    exclude = compile_excludes(args.exclude + CACHE_DB_FILES)
+
     # Expand globs
-    included = set()
     if args.files:
-        for pattern in args.files:
-            included.update(glob.glob(pattern, recursive=True))
+        # dict.fromkeys drops paths matched more than once, keeping their order
+        unique = dict.fromkeys(expand_globs(args.files, exclude))
+        files = [f for f in unique if os.path.isfile(f)]
     else:
         print("No files specified, scanning everything", file=sys.stderr)
-        included.update(glob.glob("**/*", recursive=True))
-
-    excluded = set()
-    for pattern in args.exclude:
-        excluded.update(glob.glob(pattern, recursive=True))
-
-    files_accepted = list(included - excluded) + args.files
-    files = sorted([f for f in files_accepted if os.path.isfile(f)])
-
-    if not files:
-        print(
-            "No files specified to scan (or everything was excluded). ",
-            file=sys.stderr,
-        )
-        sys.exit(ExitCodes.NOFILES)
+        files = walk(exclude=exclude)
 
     progress = Progress(
         *Progress.get_default_columns(),
@@ -157,35 +536,153 @@ def main():
         MofNCompleteColumn(),
         "Tokens found: {task.fields[tokens]}",
         console=console,
+        refresh_per_second=30,
     )
 
-    tokenizer = FileTokenizer(args.tokenizer_encoding)
+    tokenizer = FileTokenizer(
+        args.tokenizer_encoding,
+        cache=args.cache,
+        workers=args.parallel,
+        max_size=args.max_file_size,
+    )
 
-    task = progress.add_task("Tokenizing files", tokens=0, total=len(files))
+    task = progress.add_task("Tokenizing files", tokens=0, total=None)
 
     total = 0
     files_scanned = 0
+    pending = []
+    # How many of the pending files are holding their contents
+    pending_contents = 0
+    miss_digests = []
+    miss_contents = []
+    # Digests waiting to be tokenized, and how many more files share each one
+    queued = {}
+    batches = collections.deque()
+
+    last_update = 0.0
+    shown_total = 0
+
+    def show_total(force=False):
+        nonlocal last_update, shown_total
+        now = time.monotonic()
+        if total == shown_total:
+            return
+        if not force and now - last_update < PROGRESS_INTERVAL:
+            return
+        progress.update(task, tokens=humanfriendly.format_number(total))
+        last_update = now
+        shown_total = total
+
+    def record(counts):
+        nonlocal total, files_scanned
+        total += sum(counts)
+        files_scanned += len(counts)
+        progress.advance(task, len(counts))
+        show_total()
+
+    def submit_misses():
+        nonlocal miss_digests, miss_contents
+        for i in range(0, len(miss_contents), BATCH_SIZE):
+            while len(batches) >= BATCHES_AHEAD * args.parallel:
+                finish_batch()
+            digests = miss_digests[i : i + BATCH_SIZE]
+            contents = miss_contents[i : i + BATCH_SIZE]
+            batches.append((digests, tokenizer.tokenize_batch(contents)))
+        miss_digests, miss_contents = [], []
+
+    def finish_batch():
+        digests, future = batches.popleft()
+        counts = future.result()
+        tokenizer.cache_save(list(zip(digests, counts)))
+        dupes = [
+            count
+            for digest, count in zip(digests, counts)
+            for _ in range(queued.pop(digest))
+        ]
+        record(counts + dupes)
+
+    def check_cache():
+        nonlocal pending_contents
+        known = tokenizer.cache_lookup([e[2] for e in pending if e[4] is None])
+        hits = []
+        path_rows = []
+        for path, st, digest, content, count in pending:
+            if count is None:
+                path_rows.append((path, st.st_mtime_ns, st.st_size, digest))
+                count = known.get(digest)
+            if count is None:
+                if digest in queued:
+                    queued[digest] += 1
+                    continue
+                queued[digest] = 0
+                miss_digests.append(digest)
+                miss_contents.append(content)
+            else:
+                hits.append(count)
+        pending.clear()
+        pending_contents = 0
+        tokenizer.path_save(path_rows)
+        record(hits)
+        if len(miss_contents) >= BATCH_SIZE:
+            submit_misses()
+
+    files = iter(files)
+    files_found = 0
+    hashed = collections.deque()
+
+    def submit_hashes():
+        nonlocal files_found
+        wanted = HASH_AHEAD * args.parallel - len(hashed)
+        for path in itertools.islice(files, wanted):
+            hashed.append(hasher.submit(tokenizer.hash_file, path))
+            files_found += 1
+            wanted -= 1
+        if wanted > 0:
+            # Every file has been found, so we know how many there are
+            progress.update(task, total=files_found)
+
     start_time = time.monotonic()
-    with concurrent.futures.ThreadPoolExecutor(max_workers=args.parallel) as executor:
-        future_to_file = {
-            executor.submit(tokenizer.tokenize_file, path): path for path in files
-        }
+    # Hashing and tokenizing run on separate pools so that files keep being
+    # read and hashed while batches of cache misses are being encoded.
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.parallel) as hasher:
+        # Submitting as we go lets hashing start before the walk finishes
+        submit_hashes()
+        if not hashed:
+            print(
+                "No files specified to scan (or everything was excluded). ",
+                file=sys.stderr,
+            )
+            tokenizer.close()
+            sys.exit(ExitCodes.NOFILES)
+
         with progress:
             try:
-                for future in concurrent.futures.as_completed(future_to_file):
-                    try:
-                        count = future.result()
-                        total += count
-                        files_scanned += 1
-                        progress.update(
-                            task, advance=1, tokens=humanfriendly.format_number(total)
-                        )
-                    except Exception as e:
-                        print(f"Whoops exception: {e}")
-                        raise
+                while hashed:
+                    entry = hashed.popleft().result()
+                    pending.append(entry)
+                    pending_contents += entry[3] is not None
+                    submit_hashes()
+                    # Files whose contents were read are looked up sooner so
+                    # that cache hits can let go of them
+                    if (
+                        len(pending) >= LOOKUP_BATCH_SIZE
+                        or pending_contents >= BATCH_SIZE
+                    ):
+                        check_cache()
+                    while batches and batches[0][1].done():
+                        finish_batch()
+                if pending:
+                    check_cache()
+                if miss_contents:
+                    submit_misses()
+                while batches:
+                    finish_batch()
+                show_total(force=True)
             except KeyboardInterrupt:
-                executor.shutdown(wait=False, cancel_futures=True)
+                hasher.shutdown(wait=False, cancel_futures=True)
+                tokenizer.close(cancel=True)
                 sys.exit()
+    tokenizer.close()
 
     end_time = time.monotonic()
 